@@ -1,14 +1,37 @@
 from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider
 import firebase_admin
 from firebase_admin import credentials, storage, db
+from streaming_form_data import StreamingFormDataParser, ParseFailedException
+from streaming_form_data.targets import ValueTarget
+from google.api_core.exceptions import PreconditionFailed
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from threading import BoundedSemaphore, Lock
+from datetime import datetime, timezone
 import os
-import uuid
+import xxhash
 import logging
 import json
+import orjson
+import time
+import gc
+
+class OrjsonProvider(JSONProvider):
+    """Serializa las respuestas JSON con orjson (incluye datetime nativo)."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'WARNING').upper())
 logger = logging.getLogger(__name__)
 
 def initialize_firebase():
@@ -35,19 +58,100 @@ def initialize_firebase():
             "databaseURL": database_url
         })
 
-        logger.info(f"✅ Firebase inicializado: Bucket={storage_bucket}, DB={database_url}")
+        logger.info("✅ Firebase inicializado: Bucket=%s, DB=%s", storage_bucket, database_url)
         return True
 
     except Exception as e:
-        logger.error(f"❌ Error inicializando Firebase: {e}")
+        logger.error("❌ Error inicializando Firebase: %s", e)
         return False
 
 if not initialize_firebase():
     logger.error("❌ Firebase no inicializado")
     exit(1)
 
-UPLOAD_FOLDER = 'uploads'
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+BUCKET = storage.bucket()
+IMAGES_REF = db.reference('esp32cam/images')
+# Requiere lectura pública en el bucket (ver README): la URL se arma sin
+# llamar a la API
+PUBLIC_URL_BASE = f"https://storage.googleapis.com/{BUCKET.name}"
+
+CHUNK_SIZE = 1024 * 1024
+UPLOAD_RETRIES = 3
+JPEG_MAGIC = b'\xff\xd8\xff'
+LIST_FILES_LIMIT = 100
+FAILED_UPLOADS_LIMIT = 256
+EPOCH = datetime.fromtimestamp(0, timezone.utc)
+
+UPLOAD_POOL_SIZE = int(os.getenv('UPLOAD_POOL_SIZE', 8))
+UPLOAD_QUEUE_SIZE = int(os.getenv('UPLOAD_QUEUE_SIZE', UPLOAD_POOL_SIZE * 2))
+
+# Sesión HTTP del cliente de Storage con conexiones por host acordes a los
+# hilos de subida; el doble cubre también los hilos de petición que consultan
+# Storage (/list-files). Si ya hay un adaptador propio (p. ej. mTLS), se respeta.
+storage_session = BUCKET.client._http
+if type(storage_session.adapters.get('https://')) is HTTPAdapter:
+    storage_session.mount('https://', HTTPAdapter(pool_maxsize=UPLOAD_POOL_SIZE * 2))
+
+# Las subidas a Firebase se hacen fuera del hilo de la petición. Cada subida
+# en curso retiene la imagen en memoria, así que se limita cuántas se aceptan.
+upload_pool = ThreadPoolExecutor(max_workers=UPLOAD_POOL_SIZE)
+upload_slots = BoundedSemaphore(UPLOAD_QUEUE_SIZE)
+# Solo las subidas en curso de este proceso; al terminar se quitan. Los
+# fallos recientes se guardan aparte (acotados) para informarlos en /status.
+pending_uploads = {}
+failed_uploads = OrderedDict()
+pending_lock = Lock()
+
+def finish_upload(filename, future):
+    error = future.exception()
+    if error is not None:
+        logger.error("❌ Error en upload: %s", error)
+
+    with pending_lock:
+        if pending_uploads.get(filename) is future:
+            del pending_uploads[filename]
+
+        failed_uploads.pop(filename, None)
+        if error is not None:
+            failed_uploads[filename] = str(error)
+            if len(failed_uploads) > FAILED_UPLOADS_LIMIT:
+                failed_uploads.popitem(last=False)
+
+    upload_slots.release()
+
+def image_ref(filename):
+    # La entrada en RTDB se indexa por el hash del contenido (el nombre sin .jpg)
+    return IMAGES_REF.child(os.path.splitext(filename)[0])
+
+def upload_with_retry(data, path, filename):
+    blob = BUCKET.blob(path)
+    public_url = f"{PUBLIC_URL_BASE}/{path}"
+
+    for attempt in range(UPLOAD_RETRIES):
+        try:
+            # Solo crea el objeto: mismo contenido, mismo nombre, así que si ya
+            # existe (otro worker, reenvío) es la misma imagen
+            blob.upload_from_string(data, content_type='image/jpeg', if_generation_match=0, timeout=60)
+            break
+        except PreconditionFailed:
+            logger.info("♻️ Imagen repetida, ya está en Storage: %s", filename)
+            break
+        except Exception as e:
+            if attempt == UPLOAD_RETRIES - 1:
+                raise
+            logger.warning("⚠️ Reintentando %s (%d/%d): %s", filename, attempt + 1, UPLOAD_RETRIES, e)
+            time.sleep(2 ** attempt)
+
+    # Guardar URL en Firebase Realtime Database; al ir por hash, repetir la
+    # escritura deja una sola entrada
+    image_ref(filename).set({
+        'filename': filename,
+        'url': public_url,
+        'timestamp': {'.sv': 'timestamp'}
+    })
+
+    logger.info("✅ Imagen subida: %s", filename)
+    return public_url
 
 @app.route('/', methods=['GET'])
 def home():
@@ -59,64 +163,105 @@ def test():
 
 @app.route('/upload', methods=['POST'])
 def upload():
-    if 'photo' not in request.files:
+    # Parseo del multipart en streaming (sin pasar por request.files de Werkzeug)
+    photo = ValueTarget()
+    try:
+        parser = StreamingFormDataParser(headers=request.headers)
+        parser.register('photo', photo)
+        while chunk := request.stream.read(CHUNK_SIZE):
+            parser.data_received(chunk)
+    except ParseFailedException as e:
+        return jsonify({'error': f"❌ Multipart inválido: {str(e)}"}), 400
+
+    if photo.multipart_filename is None:
         return jsonify({'error': 'No se encontró archivo "photo"'}), 400
 
-    file = request.files['photo']
-    if file.filename == '':
+    if photo.multipart_filename == '':
         return jsonify({'error': 'Archivo sin nombre'}), 400
 
-    filename = f"esp32cam_{uuid.uuid4().hex}.jpg"
-    local_path = os.path.join(UPLOAD_FOLDER, filename)
+    data = photo.value
+    if not data.startswith(JPEG_MAGIC):
+        return jsonify({'error': 'El archivo no es un JPEG válido'}), 415
+
+    filename = f"esp32cam_{xxhash.xxh3_64_hexdigest(data)}.jpg"
+    size = len(data)
 
     try:
-        file.save(local_path)
-        bucket = storage.bucket()
-        blob = bucket.blob(f"esp32cam/{filename}")
-        blob.upload_from_filename(local_path, content_type='image/jpeg')
-        blob.make_public()
-        public_url = blob.public_url
-
-        # Guardar URL en Firebase Realtime Database
-        ref = db.reference('esp32cam/images')
-        new_ref = ref.push()
-        new_ref.set({
-            'filename': filename,
-            'url': public_url,
-            'timestamp': {'.sv': 'timestamp'}
-        })
+        path = f"esp32cam/{filename}"
+        public_url = f"{PUBLIC_URL_BASE}/{path}"
+
+        future = None
+        with pending_lock:
+            if filename not in pending_uploads:
+                if not upload_slots.acquire(blocking=False):
+                    return jsonify({'error': '⏳ Servidor ocupado, reintenta más tarde'}), 503
+
+                try:
+                    future = upload_pool.submit(upload_with_retry, data, path, filename)
+                except Exception:
+                    upload_slots.release()
+                    raise
 
-        os.remove(local_path)
+                pending_uploads[filename] = future
+
+        # Fuera del lock: si ya terminó, el callback corre aquí mismo
+        if future is not None:
+            future.add_done_callback(lambda f: finish_upload(filename, f))
 
         return jsonify({
-            'message': '✅ Imagen subida exitosamente',
+            'message': '📤 Imagen recibida, subiendo a Firebase',
             'filename': filename,
-            'url': public_url
-        }), 200
+            'original_filename': photo.multipart_filename,
+            'size': size,
+            'url': public_url,
+            'status_url': f"/status/{filename}"
+        }), 202
 
     except Exception as e:
-        logger.error(f"❌ Error en upload: {e}")
-        if os.path.exists(local_path):
-            os.remove(local_path)
+        logger.error("❌ Error en upload: %s", e)
         return jsonify({'error': f"❌ Error al subir imagen: {str(e)}"}), 500
 
+@app.route('/status/<filename>', methods=['GET'])
+def upload_status(filename):
+    with pending_lock:
+        future = pending_uploads.get(filename)
+        error = failed_uploads.get(filename)
+
+    if future is not None and not future.done():
+        return jsonify({'filename': filename, 'status': 'pending'}), 200
+
+    if error is not None:
+        return jsonify({'filename': filename, 'status': 'error', 'error': error}), 200
+
+    # Terminada o recibida por otro worker: la entrada en RTDB se escribe al
+    # final, así que es la referencia común
+    try:
+        registered = image_ref(filename).get() is not None
+    except Exception as e:
+        return jsonify({'error': f"❌ Error: {str(e)}"}), 500
+
+    if registered:
+        return jsonify({'filename': filename, 'status': 'done', 'url': f"{PUBLIC_URL_BASE}/esp32cam/{filename}"}), 200
+
+    # Sin registro todavía: puede seguir en curso en otro worker
+    return jsonify({'filename': filename, 'status': 'unknown'}), 200
+
 @app.route('/list-files', methods=['GET'])
 def list_files():
     try:
-        bucket = storage.bucket()
-        blobs = bucket.list_blobs(prefix='esp32cam/')
+        # Solo los campos que se usan: respuesta de GCS más pequeña
+        blobs = BUCKET.list_blobs(prefix='esp32cam/', fields='items(name,size,timeCreated),nextPageToken')
+        blobs = sorted(blobs, key=lambda b: b.time_created or EPOCH, reverse=True)
 
         files = []
-        for blob in blobs:
+        for blob in blobs[:LIST_FILES_LIMIT]:
             files.append({
                 'name': blob.name,
                 'size': blob.size,
-                'created': blob.time_created.isoformat(),
-                'url': f"https://storage.googleapis.com/{bucket.name}/{blob.name}"
+                'created': blob.time_created,
+                'url': f"{PUBLIC_URL_BASE}/{blob.name}"
             })
 
-        files.sort(key=lambda x: x['created'], reverse=True)
-
         return jsonify({'files': files}), 200
 
     except Exception as e:
@@ -126,9 +271,27 @@ def list_files():
 def health():
     return jsonify({'status': 'healthy'}), 200
 
+# Objetos de arranque fuera del GC generacional; umbral más alto para las
+# asignaciones cortas de cada petición. Con gunicorn --preload esto se hace
+# antes del fork y los workers comparten esas páginas (copy-on-write); al
+# importar no se abren conexiones ni hilos, así que precargar es seguro.
+gc.collect()
+gc.freeze()
+gc.set_threshold(100_000, 20, 20)
+
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 5000))
     debug_mode = os.getenv('FLASK_ENV') == 'development'
-    logger.info("🚀 Iniciando servidor Flask...")
-    logger.info(f"🔧 Puerto: {port}, Debug: {debug_mode}")
-    app.run(host='0.0.0.0', port=port, debug=debug_mode)
+    logger.info("🔧 Puerto: %s, Debug: %s", port, debug_mode)
+
+    if debug_mode:
+        logger.info("🚀 Iniciando servidor Flask (desarrollo)...")
+        app.run(host='0.0.0.0', port=port, debug=True)
+    else:
+        workers = os.getenv('WEB_CONCURRENCY', '4')
+        threads = os.getenv('GUNICORN_THREADS', '8')
+        logger.info("🚀 Iniciando gunicorn...")
+        os.execvp('gunicorn', [
+            'gunicorn', '--preload', '-w', workers, '-k', 'gthread', '--threads', threads,
+            '-b', f"0.0.0.0:{port}", 'app:app'
+        ])